@@ -1,49 +1,100 @@
-from fastapi import FastAPI, HTTPException, status, Depends
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, status, Depends, Header, Response
+from pydantic import TypeAdapter
 from sqlmodel import Session
 from models import StudentCreate, StudentRead, StudentUpdate
 from database import engine, create_db_and_tables
 import crud
 engine.echo = False
 
+# Building a TypeAdapter is the expensive part, so we build it once here and reuse it for every request.
+# We use them to turn our results into JSON ourselves. With response_model, FastAPI would first validate every result
+# against StudentRead again, even though we already know it has the right shape.
+student_adapter = TypeAdapter(StudentRead)
+students_adapter = TypeAdapter(list[StudentRead])
 
-app = FastAPI()
 
+def json_response(content: bytes, headers: dict[str, str] | None = None) -> Response:
+    return Response(content=content, media_type="application/json", headers=headers)
 
-# @app.on_event("startup")
-# def on_startup():
-#     create_db_and_tables()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # on_event("startup") is deprecated, so we use a lifespan handler instead.
+    # The code before the yield runs once when the app starts and the code after it runs once when it shuts down.
+    create_db_and_tables()
+    yield
+    # Close the connections the engine has been keeping in its pool.
+    engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 def get_session():
-    with Session(engine) as session:
+    # expire_on_commit=False keeps the attributes of our objects loaded after a commit, so returning them in the
+    # response doesn't have to go back to the database to load them again.
+    with Session(engine, expire_on_commit=False) as session:
         yield session
 
 
-@app.post(path="/student", response_model=StudentRead)
+# response_model=None tells FastAPI not to validate what we return, and responses= still puts the model in the docs.
+@app.post(path="/student", response_model=None, responses={200: {"model": StudentRead}})
 def create_student(student: StudentCreate, session: Session = Depends(get_session)):
-    return crud.create_students(session, student)
+    return json_response(student_adapter.dump_json(crud.create_students(session, student)))
+
+
+@app.post(path="/students/bulk", response_model=None, responses={200: {"model": list[StudentRead]}})
+def create_students_bulk(students: list[StudentCreate], session: Session = Depends(get_session)):
+    return json_response(students_adapter.dump_json(crud.create_students_bulk(session, students)))
 
 
-@app.get(path="/students", response_model=list[StudentRead])
+@app.get(path="/students", response_model=None, responses={200: {"model": list[StudentRead]}})
 def read_students(session: Session = Depends(get_session)):
-    return crud.get_students(session)
+    # The list can get big, so instead of letting FastAPI go through jsonable_encoder and the json module,
+    # we let pydantic-core turn it into JSON bytes directly.
+    return json_response(students_adapter.dump_json(crud.get_students(session)))
 
 
-@app.get("/students/{matric_number}", response_model=StudentRead)
-def read_student(matric_number: str, session: Session = Depends(get_session)):
-    student = crud.get_student_by_matric_number(session, matric_number)
-    if not student:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail="Student not found")
-    return student
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match can hold several ETags and they may be sent as weak ones (W/"...").
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
 
 
-@app.patch("/students/{matric_number}", response_model=StudentRead)
-def update_student(matric_number: str, student: StudentUpdate, session: Session = Depends(get_session)):
-    db_student = crud.update_student(session, matric_number, student)
+@app.get("/students/{matric_number}", response_model=None,
+         responses={200: {"model": StudentRead},
+                    304: {"description": "The student hasn't changed since the ETag sent in If-None-Match"}})
+def read_student(matric_number: str, if_none_match: str | None = Header(default=None),
+                 session: Session = Depends(get_session)):
+    cached = crud.get_student_and_etag(session, matric_number)
+    if not cached:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Student not found")
+    student, etag = cached
+    # Let the client reuse this response for a while instead of asking us again,
+    # and after that, ask us with If-None-Match whether the copy it has is still the current one.
+    headers = {"Cache-Control": "private, max-age=30", "ETag": etag}
+    if if_none_match is not None and etag_matches(if_none_match, etag):
+        # The client already has this student, so we send no body and skip serializing it.
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return json_response(student_adapter.dump_json(student), headers)
+
+
+@app.patch("/students/{matric_number}", response_model=None,
+           responses={200: {"model": StudentRead},
+                      204: {"description": "The student was updated and return_row=false was sent"}})
+def update_student(matric_number: str, student: StudentUpdate, return_row: bool = True,
+                   session: Session = Depends(get_session)):
+    # Clients that don't need the updated student back can send ?return_row=false and save us a SELECT.
+    db_student = crud.update_student(
+        session, matric_number, student, return_row)
     if not db_student:
         raise HTTPException(status_code=404, detail="Student not found")
-    return db_student
+    if not return_row:
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    return json_response(student_adapter.dump_json(db_student))
 
 
 @app.delete("/students/{matric_number}")
@@ -1,9 +1,12 @@
+import logging
 from fastapi import FastAPI, HTTPException, status, Depends
 from sqlmodel import Session, select
 from models import Student, StudentCreate, StudentRead, StudentUpdate
 from database import engine, create_db_and_tables
 engine.echo = False
 app = FastAPI()
+# print() writes to stdout on every request. A debug log does nothing unless we turn debug logging on.
+logger = logging.getLogger(__name__)
 
 
 @app.on_event("startup")
@@ -14,7 +17,7 @@ def on_startup():
 @app.post(path="/student", response_model=StudentRead)
 # This will validate that all the data that we promised is there and will remove any data we didn't declare.
 def create_student(student: StudentCreate):
-    print("hi this is student:", student)
+    logger.debug("hi this is student: %s", student)
     # Apparently when you make a SQLModel Model with table=True, you don't get the data validation. So you eiher have to create a pydantic model for validation by removing table=True and at the same time, you should still have your table model with table=True.
     # Here, we create a new Student(db_student) (this is the actual table model that saves things to the database) using Student.model_validate().
     # The method .model_validate() reads data from another object with attributes (or a dict) and creates a new instance of this class, in this case Student. So like it is pretty much finding the attributes that the Student model has that are in the StudentCreate model or the model in the model_validate
@@ -59,7 +62,7 @@ def update_student(matric_number: str, student: StudentUpdate):
         if not db_student:
             raise HTTPException(status_code=404, detail="Student not found")
         student_data = student.model_dump(exclude_unset=True)
-        print("Student data is:", student_data)
+        logger.debug("Student data is: %s", student_data)
         for key, value in student_data.items():
             setattr(db_student, key, value)
         session.add(db_student)
@@ -93,17 +96,6 @@ def update_student(matric_number: str, student: StudentUpdate):
 # because the client specified a value rather than not sending anything and this can cause errors. if the column is meant to be non null
 
 
-@app.delete("/students/{matric_number}")
-def delete_student(matric_number: str):
-    with Session(engine) as session:
-        student = session.get(Student, matric_number)
-        if not student:
-            raise HTTPException(status_code=404, detail="Student not found")
-        session.delete(student)
-        session.commit()
-        return {"ok": True}
-
-
 # A better way to create sessions. use dependencies. Why? Most of the time, the traditional method is good but in many use cases we would want to use FastAPI Dependencies, for example to verify that the client is logged in and get the current user before executing any other code in the path operation.
 # These dependencies are also very useful during testing, because we can easily replace them, and then, for example, use a new database for our tests, or put some data before the tests, etc.
 
@@ -1,35 +1,139 @@
-from sqlmodel import Session, select, or_, col
+import hashlib
+import threading
+from cachetools import TTLCache
+from sqlalchemy import bindparam
+from sqlmodel import Session, select, update, or_, col
 from models import StudentCreate, Student, StudentRead, StudentUpdate
 
+# Our tables have no server side defaults, so after a commit we already know every column of the row we wrote.
+# Turn this on if a table ever gets columns the database fills in, so we read them back with session.refresh().
+REFRESH_AFTER_WRITE = False
+
+# Students rarely change between updates, so we keep the ones we have read in memory for a minute, keyed by matric number.
+# Next to each student we keep its ETag, so repeated requests don't have to hash it again.
+# Anything that changes or deletes a student has to remove it from here.
+student_cache: TTLCache[str, tuple[StudentRead, str]] = TTLCache(maxsize=10000, ttl=60)
+# FastAPI runs our path operations in a threadpool, so several requests can use the cache at the same time.
+# TTLCache isn't thread safe on its own, so every read and write of it goes through this lock.
+student_cache_lock = threading.Lock()
+# The lock alone isn't enough: a request can read a student from the database, then another request updates that
+# student and removes it from the cache, and only then the first request puts the old student in the cache.
+# So every write bumps this version, and a read only caches what it loaded if no write happened in the meantime.
+student_cache_version = 0
+
+# The statements we run on every request are built once here, with a bindparam where the matric number goes,
+# so each request only has to pass in its value instead of building the statement again.
+select_students = select(Student.matric_number, Student.first_name,
+                         Student.last_name, Student.email)
+select_student_by_matric_number = select(Student).where(
+    Student.matric_number == bindparam("matric_number"))
+
+
+def student_etag(student: StudentRead) -> str:
+    # We hash the same JSON we send in the response body, so the ETag changes whenever the body does.
+    # Joining the values ourselves wouldn't be enough, for example email=None and email="None" would give the same ETag.
+    return '"' + hashlib.blake2b(student.model_dump_json().encode(), digest_size=8).hexdigest() + '"'
+
+
+def to_student_read(student) -> StudentRead:
+    # Copy only the fields of StudentRead, so the password, or any column we add to Student later, is never sent back.
+    # The values come from our own table, so model_construct() can skip validating them again.
+    return StudentRead.model_construct(**{field: getattr(student, field) for field in StudentRead.model_fields})
+
 
 def create_students(session: Session, student: StudentCreate) -> StudentRead:
-    db_student = Student.model_validate(student)
+    # FastAPI has already validated the request body against StudentCreate, which has the same fields as Student.
+    # Creating a table model with Student(...) doesn't validate, so we don't pay for validating the same data twice.
+    db_student = Student(**student.__dict__)
     session.add(db_student)
     session.commit()
-    session.refresh(db_student)
-    return db_student
+    if REFRESH_AFTER_WRITE:
+        session.refresh(db_student)
+    return to_student_read(db_student)
+
+
+def create_students_bulk(session: Session, students: list[StudentCreate]) -> list[StudentRead]:
+    # All the students are added in one transaction, so we only pay for one commit no matter how many students there are.
+    db_students = [Student(**student.__dict__) for student in students]
+    session.add_all(db_students)
+    session.commit()
+    if REFRESH_AFTER_WRITE:
+        for db_student in db_students:
+            session.refresh(db_student)
+    return [to_student_read(db_student) for db_student in db_students]
 
 
 def get_students(session: Session) -> list[StudentRead]:
-    return session.exec(select(Student)).all()
+    # Selecting just the columns we send back gives us plain rows instead of full Student objects tracked by the session.
+    # The rows come straight from our own table, so there is nothing to validate and model_construct() can skip it.
+    return [StudentRead.model_construct(matric_number=matric_number, first_name=first_name, last_name=last_name, email=email)
+            for matric_number, first_name, last_name, email in session.exec(select_students).all()]
 
 
-def get_student_by_matric_number(session: Session, matric_number: str) -> StudentRead | None:
-    return session.get(Student, matric_number)
+def invalidate_cached_student(matric_number: str):
+    # Call this after the change is committed, so a read that starts afterwards can only see the new data.
+    global student_cache_version
+    with student_cache_lock:
+        student_cache_version += 1
+        student_cache.pop(matric_number, None)
 
 
-def update_student(session: Session, matric_number: str, student_info_to_update: StudentUpdate):
-    db_student = session.get(Student, matric_number)
+def get_student_and_etag(session: Session, matric_number: str) -> tuple[StudentRead, str] | None:
+    with student_cache_lock:
+        cached = student_cache.get(matric_number)
+        version = student_cache_version
+    if cached is not None:
+        return cached
+    db_student = session.exec(select_student_by_matric_number, params={
+                              "matric_number": matric_number}).one_or_none()
     if not db_student:
         return None
-    student_dict_to_update = student_info_to_update.model_dump(
-        exclude_unset=True)
-    for key, value in student_dict_to_update.items():
-        setattr(db_student, key, value)
-    session.add(db_student)
+    # We cache a StudentRead rather than the table model, so the cached value has no password and isn't tied to this session.
+    student = to_student_read(db_student)
+    cached = (student, student_etag(student))
+    with student_cache_lock:
+        # If the version changed, a write was committed while we were reading, so what we have might already be old.
+        if student_cache_version == version:
+            student_cache[matric_number] = cached
+    return cached
+
+
+def get_student_by_matric_number(session: Session, matric_number: str) -> StudentRead | None:
+    cached = get_student_and_etag(session, matric_number)
+    if cached is None:
+        return None
+    return cached[0]
+
+
+def update_student(session: Session, matric_number: str, student_info_to_update: StudentUpdate, return_row: bool = True):
+    # model_fields_set holds only the fields the client sent, which is what model_dump(exclude_unset=True) gives us,
+    # without asking pydantic to build the whole dump for a model with just a handful of fields.
+    student_dict_to_update = {field: getattr(student_info_to_update, field)
+                              for field in student_info_to_update.model_fields_set}
+    if not student_dict_to_update:
+        # Nothing to change, we only have to tell whether the student exists.
+        db_student = session.get(Student, matric_number)
+        if not db_student:
+            return None
+        return to_student_read(db_student) if return_row else "ok"
+    # A single UPDATE ... WHERE matric_number = ? instead of loading the student, setting its attributes in Python
+    # and writing it back. rowcount tells us whether there was a student with that matric number at all.
+    statement = update(Student).where(Student.matric_number == matric_number).values(
+        **student_dict_to_update)
+    result = session.exec(statement)
     session.commit()
-    session.refresh(db_student)
-    return db_student
+    if result.rowcount == 0:
+        return None
+    invalidate_cached_student(matric_number)
+    # Only go back to the database for the updated student if the caller wants it back.
+    if not return_row:
+        return "ok"
+    # If this session already loaded the student, the UPDATE above has also updated that object,
+    # and session.get() hands it back from the identity map without another SELECT.
+    db_student = session.get(Student, matric_number)
+    if REFRESH_AFTER_WRITE:
+        session.refresh(db_student)
+    return to_student_read(db_student)
 
 
 def delete_student(session: Session, matric_number: str):
@@ -38,4 +142,5 @@ def delete_student(session: Session, matric_number: str):
         return None
     session.delete(student)
     session.commit()
+    invalidate_cached_student(matric_number)
     return "ok"
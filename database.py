@@ -1,5 +1,7 @@
 from models import Student
 from sqlmodel import create_engine, SQLModel
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool, StaticPool
 import os
 from dotenv import load_dotenv
 load_dotenv()
@@ -7,7 +9,54 @@ load_dotenv()
 sqlite_file_name = "students.db"
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 postgres_url = os.getenv("POSTGRES_DB_URL")
-engine = create_engine(url=sqlite_url, echo=True)
+
+
+def pool_options(url: str) -> dict:
+    # An in memory database only lives as long as its connection, so every session has to share that one connection.
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        return {"poolclass": StaticPool, "connect_args": {"check_same_thread": False}}
+    # For any other database we keep a pool of connections open.
+    # pool_pre_ping checks that a connection is still alive before handing it out and pool_recycle replaces old ones.
+    options = {
+        "poolclass": QueuePool,
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_pre_ping": True,
+        "pool_recycle": 1800,
+    }
+    # FastAPI runs our path operations in a threadpool, so a connection can be used by a different thread than the one
+    # that opened it, hence check_same_thread=False. This is a sqlite3 option, other drivers don't know it.
+    if url.startswith("sqlite"):
+        options["connect_args"] = {"check_same_thread": False}
+    return options
+
+
+# query_cache_size is how many compiled SQL statements the engine keeps around, so it doesn't have to compile the
+# same statement again for every request.
+engine = create_engine(url=sqlite_url, echo=True,
+                       query_cache_size=1200, **pool_options(sqlite_url))
+
+
+# The engine keeps its connections in a pool and hands them out again for later requests, so we only pay the
+# connection setup once per connection instead of once per request. The PRAGMAs below are per connection settings,
+# so we apply them here when the connection is first opened and every pooled connection inherits them.
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # These PRAGMAs only exist in SQLite, so leave the connection alone if the engine points at another database.
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    # In WAL mode writers append to a log instead of rewriting the database file, and readers don't wait on writers.
+    cursor.execute("PRAGMA journal_mode=WAL")
+    # With WAL, NORMAL only syncs to disk at checkpoints instead of on every commit, and is still safe from corruption.
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    # Read the database file through a 256MB memory map instead of read() calls.
+    cursor.execute("PRAGMA mmap_size=268435456")
+    # Keep temporary tables and indices in memory.
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    # A negative cache_size is in KiB, so this is a 64MB page cache per connection.
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.close()
 
 
 def create_db_and_tables():
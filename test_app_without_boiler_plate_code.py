@@ -7,32 +7,65 @@
 # In pytest, these things are called fixtures instead of dependencies.
 # Let's use these fixtures to improve our code and reduce de duplicated boilerplate for the next tests.
 
+import operator
 import pytest
 from fastapi.testclient import TestClient
 from sqlmodel import create_engine, SQLModel, Session
 from sqlmodel.pool import StaticPool
+from sqlalchemy import event
 from app_with_crud_file import get_session, app
-from models import Student
+from models import Student, StudentRead
+import crud
 
 # Use the @pytest.fixture() decorator on top of the function to tell pytest that this is a fixture function (equivalent to a FastAPI dependency).
 # We also give it a name of "session", this will be important in the testing function.
 
 # I just remembered that in the response to my api, i don't include passowrds. So i am not going to be comparing password
 fields_to_compare = [x for x in Student.model_fields if x != "password"]
+# attrgetter with several names returns a tuple of all those attributes, so comparing two students is one tuple comparison.
+get_fields_to_compare = operator.attrgetter(*fields_to_compare)
 
 
-@pytest.fixture(name="session")
-def session_fixture():  # This is equivalent to a FastAPI dependency function.
+@pytest.fixture(name="engine", scope="session")
+def engine_fixture():
+    # scope="session" means pytest only runs this once for the whole test run, so we create the in memory database
+    # and its tables once instead of once for every test.
     engine = create_engine(
         "sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool
     )
+
+    # The sqlite3 module starts and ends transactions on its own, which breaks the savepoints we use in the session fixture.
+    # So we switch that off and let SQLAlchemy emit the BEGIN itself. This is the workaround from the SQLAlchemy docs for pysqlite.
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
     # Remember that order matters. So when we execute this line, since we imported from app_with_Crud_file, all the codes in this better_app is executed including the one where we put like the Student class
     SQLModel.metadata.create_all(engine)
-    with Session(engine) as session:
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture(name="session")
+def session_fixture(engine):  # This is equivalent to a FastAPI dependency function.
+    # Since all the tests share one database, every test runs inside a transaction that we roll back at the end,
+    # so nothing a test writes is left behind for the next one.
+    # join_transaction_mode="create_savepoint" makes session.commit() only release a savepoint inside our transaction,
+    # so even the commits made by the app and by the tests get rolled back.
+    connection = engine.connect()
+    transaction = connection.begin()
+    # Same as get_session in the app, so the responses are built from the objects we just committed without reloading them.
+    with Session(bind=connection, expire_on_commit=False, join_transaction_mode="create_savepoint") as session:
         yield session
         # The thing that we return or yield is what will be available to the test function, in this case, the session object.
         # Here we use yield so that pytest comes back to execute "the rest of the code" in this function once the testing function is done.
-        # We don't have any more visible "rest of the code" after the yield, but we have the end of the with block that will close the session.
+        # The rest of the code here is the end of the with block that will close the session, and then undoing everything the test did.
+    transaction.rollback()
+    connection.close()
 
 
 def test_create_hero(session: Session):
@@ -57,7 +90,7 @@ def test_create_hero(session: Session):
     assert response.json() == {"matric_number": "21cg029882",
                                "first_name": "Adebola", "last_name": "Odufuwa", "email": "adeboladuf@gmail.com"}
 
-# pytest will make sure to run these fixture functions right before (and finish them right after) each test function that uses them or depens on them. So, each test function will actually have its own database, engine, and session.
+# pytest will make sure to run these fixture functions right before (and finish them right after) each test function that uses them or depens on them. So, each test function will actually have its own session and transaction, while the engine and database are shared and created only once.
 
 
 # So one more thing is that if we were to continue with this code format for all the tests we are going to run, we would end up with a lot of boiler plate code.
@@ -65,18 +98,26 @@ def test_create_hero(session: Session):
 # To prevent this, we would have another fixture and this fixture like fastapi dependency would have a sub fixture or would depend on another fixture
 
 
+@pytest.fixture(name="shared_client", scope="session")
+def shared_client_fixture():
+    # The TestClient itself doesn't depend on anything a test does, so like the engine we only create it once.
+    return TestClient(app)
+
+
 @pytest.fixture(name="client")
 # now this fixture is depending on the session fixture
-def client_fixture(session: Session):
+def client_fixture(session: Session, shared_client: TestClient):
+    # What changes from test to test is the session, so we only swap the dependency override for every test.
     def get_session_override():
         return session
     app.dependency_overrides[get_session] = get_session_override
-    client = TestClient(app)
 
-    yield client
+    yield shared_client
     # This code would be executed since we used the yield
     # This is the cleanup code, after yield, and after the test function is done.
     app.dependency_overrides.clear()
+    # Every test's data is rolled back at the end, so students cached by one test must not show up in the next one.
+    crud.student_cache.clear()
 
 
 def test_create_hero(client: TestClient):
@@ -90,6 +131,22 @@ def test_create_hero(client: TestClient):
                                "first_name": "Adebola", "last_name": "Odufuwa", "email": "adeboladuf@gmail.com"}
 
 
+def test_create_students_bulk(client: TestClient, session: Session):
+    response = client.post(
+        "/students/bulk",
+        json=[{"password": "someone", "matric_number": "21cg029882",
+               "first_name": "Adebola", "last_name": "Odufuwa", "email": "adeboladuf@gmail.com"},
+              {"password": "someone", "matric_number": "21cg029883",
+               "first_name": "Oluwaferanmi", "last_name": "Odufuwa"}]
+    )
+    assert response.status_code == 200
+    assert response.json() == [{"matric_number": "21cg029882", "first_name": "Adebola",
+                                "last_name": "Odufuwa", "email": "adeboladuf@gmail.com"},
+                               {"matric_number": "21cg029883", "first_name": "Oluwaferanmi",
+                                "last_name": "Odufuwa", "email": None}]
+    assert session.get(Student, "21cg029883") is not None
+
+
 def test_create_hero_incomplete(client: TestClient):
     response = client.post(
         "/student",
@@ -130,16 +187,15 @@ def test_get_students(client: TestClient, session: Session):
     assert response.status_code == 200
     assert len(data) == 2
     # I don't know if this logic is even correct. but i think it is. Like i think i am mistakening it for that equality and identitiy stuff. But this one has to do with equality not identity
-    received_student1 = Student(**data[0])
-    received_student2 = Student(**data[1])
-
-    are_equal1 = all([getattr(received_student1, attr) ==
-                     getattr(student_1, attr) for attr in fields_to_compare])
-    are_equal2 = all([getattr(received_student2, attr) ==
-                     getattr(student_2, attr) for attr in fields_to_compare])
+    # The responses have the shape of StudentRead and come from our own API, so there is nothing to validate here
+    # and model_construct() skips it. Student.model_construct() can't be used, table models built that way aren't usable.
+    received_student1 = StudentRead.model_construct(**data[0])
+    received_student2 = StudentRead.model_construct(**data[1])
 
-    assert are_equal1
-    assert are_equal2
+    assert get_fields_to_compare(
+        received_student1) == get_fields_to_compare(student_1)
+    assert get_fields_to_compare(
+        received_student2) == get_fields_to_compare(student_2)
 
 
 def test_get_student(session: Session, client: TestClient):
@@ -152,11 +208,84 @@ def test_get_student(session: Session, client: TestClient):
     data = response.json()
 
     assert response.status_code == 200
-    received_student = Student(**data)
+    assert response.headers["Cache-Control"] == "private, max-age=30"
+    received_student = StudentRead.model_construct(**data)
+
+    assert get_fields_to_compare(
+        received_student) == get_fields_to_compare(student)
+
+
+def test_get_student_not_modified(session: Session, client: TestClient):
+    student = Student(matric_number="21cg029882", first_name="Adebola",
+                      last_name="Odufuwa", password="password")
+    session.add(student)
+    session.commit()
+
+    response = client.get(f"/students/{student.matric_number}")
+    etag = response.headers["ETag"]
+
+    response = client.get(f"/students/{student.matric_number}",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["ETag"] == etag
+
+    # Once the student changes, the old ETag is no longer the current one, so we get the student back.
+    client.patch(f"/students/{student.matric_number}",
+                 json={"email": "adeboladuf@gmail.com"})
+    response = client.get(f"/students/{student.matric_number}",
+                          headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_student_etag_changes_with_the_body():
+    # These pairs would look the same if we only joined the values with "|", but their JSON bodies differ.
+    assert crud.student_etag(StudentRead(matric_number="21cg029882", first_name="Adebola", last_name="Odufuwa", email=None)) != \
+        crud.student_etag(StudentRead(matric_number="21cg029882",
+                          first_name="Adebola", last_name="Odufuwa", email="None"))
+    assert crud.student_etag(StudentRead(matric_number="21cg029882", first_name="a|b", last_name="c")) != \
+        crud.student_etag(StudentRead(
+            matric_number="21cg029882", first_name="a", last_name="b|c"))
+
+
+def test_get_student_after_patch(session: Session, client: TestClient):
+    # The first get puts the student in the cache, the patch has to take it out again so we don't get the old email back.
+    student = Student(matric_number="21cg029882", first_name="Adebola",
+                      last_name="Odufuwa", password="password")
+    session.add(student)
+    session.commit()
+
+    response = client.get(f"/students/{student.matric_number}")
+    assert response.json()["email"] is None
+
+    client.patch(f"/students/{student.matric_number}",
+                 json={"email": "adeboladuf@gmail.com"})
+    response = client.get(f"/students/{student.matric_number}")
+    assert response.status_code == 200
+    assert response.json()["email"] == "adeboladuf@gmail.com"
+
+
+def test_student_cache_skips_students_read_before_a_write(session: Session, monkeypatch: pytest.MonkeyPatch):
+    student = Student(matric_number="21cg029882", first_name="Adebola",
+                      last_name="Odufuwa", password="password")
+    session.add(student)
+    session.commit()
+
+    session_exec = session.exec
+
+    def exec_then_concurrent_write(*args, **kwargs):
+        result = session_exec(*args, **kwargs)
+        # This is where another request's PATCH commits and removes the student from the cache,
+        # while this read is still holding the student it loaded before that.
+        crud.invalidate_cached_student(student.matric_number)
+        return result
 
-    are_equal = all([getattr(received_student, attr) ==
-                     getattr(student, attr) for attr in fields_to_compare])
-    assert are_equal
+    monkeypatch.setattr(session, "exec", exec_then_concurrent_write)
+    assert crud.get_student_by_matric_number(
+        session, student.matric_number) is not None
+    # What we read may be older than the write, so it must not end up in the cache.
+    assert student.matric_number not in crud.student_cache
 
 
 def test_patch_student(session: Session, client: TestClient):
@@ -172,11 +301,45 @@ def test_patch_student(session: Session, client: TestClient):
     student.email = "adeboladuf@gmail.com"
 
     assert response.status_code == 200
-    received_student = Student(**data)
+    received_student = StudentRead.model_construct(**data)
+
+    assert get_fields_to_compare(
+        received_student) == get_fields_to_compare(student)
+
 
-    are_equal = all([getattr(received_student, attr) ==
-                     getattr(student, attr) for attr in fields_to_compare])
-    assert are_equal
+def test_patch_student_response_fields(session: Session, client: TestClient):
+    student = Student(matric_number="21cg029882", first_name="Adebola",
+                      last_name="Odufuwa", password="password")
+    session.add(student)
+    session.commit()
+    # Make the patch load the student from the database again, like it would in a new request.
+    session.expire_all()
+
+    response = client.patch(
+        f"/students/{student.matric_number}", json={"email": "adeboladuf@gmail.com"})
+
+    assert response.status_code == 200
+    # Only the fields of StudentRead, in the order they are declared, no matter how the row was loaded.
+    assert list(response.json()) == list(StudentRead.model_fields)
+
+
+def test_patch_student_without_returning_it(session: Session, client: TestClient):
+    student = Student(matric_number="21cg029882", first_name="Adebola",
+                      last_name="Odufuwa", password="password")
+    session.add(student)
+    session.commit()
+
+    response = client.patch(
+        f"/students/{student.matric_number}", params={"return_row": False}, json={"email": "adeboladuf@gmail.com"})
+
+    assert response.status_code == 204
+    assert session.get(Student, student.matric_number).email == "adeboladuf@gmail.com"
+
+
+def test_patch_student_not_found(client: TestClient):
+    response = client.patch(
+        "/students/21cg029882", json={"email": "adeboladuf@gmail.com"})
+    assert response.status_code == 404
 
 
 def test_delete_student(session: Session, client: TestClient):